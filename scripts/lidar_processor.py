@@ -1,18 +1,63 @@
 import numpy as np
+import pandas as pd
 import pdal
+import os
 import json
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from math import ceil
 import geopandas as gpd
-import matplotlib.pyplot as plt
-from shapely.geometry import Polygon, Point
+import shapely
+import shapely.ops
+from pyproj import Transformer
+from shapely.geometry import Polygon
 
 from app_logger import App_Logger
 from file_handler import FileHandler
 
+
+@lru_cache(maxsize=64)
+def _get_transformer(src_epsg: int, dst_epsg: int) -> Transformer:
+    """
+    This function returns a cached transformer between two coordinate reference systems.
+
+    Args:
+        src_epsg (int): [the source coordinate reference system(CRS)]
+        dst_epsg (int): [the destination coordinate reference system(CRS)]
+
+    Returns:
+        [pyproj.Transformer]: [a transformer object]
+    """
+    return Transformer.from_crs(src_epsg, dst_epsg, always_xy=True)
+
+
+def _bounds_string(minx: float, miny: float, maxx: float, maxy: float) -> str:
+    """
+    This function formats bounds as a pdal bounds string.
+
+    Args:
+        minx (float): [the minimum x coordinate]
+        miny (float): [the minimum y coordinate]
+        maxx (float): [the maximum x coordinate]
+        maxy (float): [the maximum y coordinate]
+
+    Returns:
+        [str]: [bounds string]
+    """
+    return f"({[minx, maxx]},{[miny,maxy]})"
+
+
 class LidarProcessor:
     """
     This class contains functons useful for fetching, manipulating, and visualizing LIDAR point cloud data.
     """
 
+    # parsed pipeline templates shared by all instances, keyed by absolute json path. never handed out directly.
+    _pipeline_templates = {}
+    # the largest number of bounding boxes whose regions are memoized per instance
+    _regions_cache_size = 256
+
     def __init__(self, public_data_url: str = "https://s3-us-west-2.amazonaws.com/usgs-lidar-public/", pipeline_json_path: str="../assets/get_data.json") -> None:
         """
         This method is used to instantiate the class.
@@ -23,16 +68,70 @@ class LidarProcessor:
         """
         self.logger = App_Logger().get_logger(__name__)
         self.file_handler = FileHandler()
-        self.pipeline_json = self.file_handler.read_json(pipeline_json_path)
+        self.pipeline_json = self.get_pipeline_template(pipeline_json_path)
         self.public_data_url = public_data_url
         self.input_epsg = 3857
         self.metadata = self.file_handler.read_csv("../assets/usgs_3dep_metadata.csv")
         values = {"year": 0}
         self.metadata.fillna(value=values, inplace=True)
+        self._meta_xmin = self.metadata.xmin.to_numpy()
+        self._meta_xmax = self.metadata.xmax.to_numpy()
+        self._meta_ymin = self.metadata.ymin.to_numpy()
+        self._meta_ymax = self.metadata.ymax.to_numpy()
+        self._meta_filename = self.metadata.filename.to_numpy()
+        self._meta_year = self.metadata.year.to_numpy()
+        self._regions_cache = {}
+        self._filename_to_year = dict(zip(self.metadata.filename, self.metadata.year.astype(int).tolist()))
+
+    def get_pipeline_template(self, pipeline_json_path: str) -> dict:
+        """
+        This method returns a copy of the parsed pipeline template, reading the json file only the first time it is requested.
+
+        Args:
+            pipeline_json_path (str): [the json file describing the pipeline structure]
+
+        Returns:
+            [dict]: [a copy of the pipeline template dictionary that the caller may modify]
+        """
+        templates = LidarProcessor._pipeline_templates
+        key = os.path.abspath(pipeline_json_path)
+        if key not in templates:
+            pipeline_json = self.file_handler.read_json(pipeline_json_path)
+            if pipeline_json is None:
+                return None
+            templates[key] = pipeline_json
+        return copy.deepcopy(templates[key])
+
+    def get_input_bounds(self, polygon: Polygon) -> tuple:
+        """
+        This method returns the bounds of a polygon after reprojecting it to the input CRS.
+
+        Args:
+            polygon (Polygon): [a polygon object in the output CRS]
+
+        Returns:
+            [tuple]: [minx, miny, maxx, maxy in the input CRS]
+        """
+        xs, ys = polygon.exterior.coords.xy
+        xcords, ycords = _get_transformer(self.output_epsg, self.input_epsg).transform(xs, ys)
+        return min(xcords), min(ycords), max(xcords), max(ycords)
+
+    def get_polygon_bounds(self, polygon: Polygon) -> str:
+        """
+        This method returns the bounds of a polygon in the input CRS as a pdal bounds string.
+
+        Args:
+            polygon (Polygon): [a polygon object]
+
+        Returns:
+            [str]: [bounds string]
+        """
+        return _bounds_string(*self.get_input_bounds(polygon))
 
     def get_polygon_boundaries(self, polygon: Polygon):
         """
         This method returns the bounds and exterior coordinates of a polygon as strings.
+        The polygon is reprojected once and both strings are taken from the reprojected polygon.
 
         Args:
             polygon (Polygon): [a polygon object]
@@ -40,24 +139,15 @@ class LidarProcessor:
         Returns:
             [tuple]: [bounds string and polygon exterior coordinates string]
         """
-        polygon_df = gpd.GeoDataFrame([polygon], columns=['geometry'])
-
-        polygon_df.set_crs(epsg=self.output_epsg, inplace=True)
-        polygon_df['geometry'] = polygon_df['geometry'].to_crs(epsg=self.input_epsg)
-        minx, miny, maxx, maxy = polygon_df['geometry'][0].bounds
-
-        polygon_input = 'POLYGON(('
-        xcords, ycords = polygon_df['geometry'][0].exterior.coords.xy
-        for x, y in zip(list(xcords), list(ycords)):
-            polygon_input += f'{x} {y}, '
-        polygon_input = polygon_input[:-2]
-        polygon_input += '))'
+        transformed_polygon = shapely.ops.transform(_get_transformer(self.output_epsg, self.input_epsg).transform, polygon)
+        polygon_input = transformed_polygon.wkt
 
-        return f"({[minx, maxx]},{[miny,maxy]})", polygon_input
+        return _bounds_string(*transformed_polygon.bounds), polygon_input
 
     def get_pipeline(self, region: str, polygon: Polygon):
         """
         This method fills the empty values in the pipeline dictionary and creates a pdal pipeline object.
+        The pipeline only reads the bounding box of the polygon, the crop is applied afterwards by crop_to_polygon.
 
         Args:
             region (str): [the filename of the region where the data is extracted from]
@@ -66,16 +156,16 @@ class LidarProcessor:
         Returns:
             [pdal.Pipeline]: [pdal pipeline object]
         """
-        boundaries, polygon_input = self.get_polygon_boundaries(polygon)
+        boundaries = self.get_polygon_bounds(polygon)
 
         full_dataset_path = f"{self.public_data_url}{region}/ept.json"
 
-        self.pipeline_json['pipeline'][0]['filename'] = full_dataset_path
-        self.pipeline_json['pipeline'][0]['bounds'] = boundaries
-        self.pipeline_json['pipeline'][1]['polygon'] = polygon_input
-        self.pipeline_json['pipeline'][3]['out_srs'] = f'EPSG:{self.output_epsg}'
+        pipeline_json = copy.deepcopy(self.pipeline_json)
+        pipeline_json['pipeline'][0]['filename'] = full_dataset_path
+        pipeline_json['pipeline'][0]['bounds'] = boundaries
+        pipeline_json['pipeline'][2]['out_srs'] = f'EPSG:{self.output_epsg}'
 
-        pipeline = pdal.Pipeline(json.dumps(self.pipeline_json))
+        pipeline = pdal.Pipeline(json.dumps(pipeline_json))
 
         return pipeline
 
@@ -102,6 +192,35 @@ class LidarProcessor:
             self.logger.exception('Pipeline execution failed')
             print(e)
 
+    def stream_pipeline(self, polygon: Polygon, epsg, region: str = "IA_FullState", chunk_size: int = 1_000_000, prefetch: int = 2):
+        """
+        This method runs a pdal pipeline in streaming mode and yields the fetched data in chunks.
+        pdal reads up to prefetch chunks ahead in the background while the caller processes the current one.
+
+        Args:
+            polygon (Polygon): [a polygon object]
+            epsg (int): [the desired coordinate reference system(CRS)]
+            region (str, optional): [the filename of the region where the data is extracted from]. Defaults to "IA_FullState".
+            chunk_size (int, optional): [the maximum number of points in each chunk]. Defaults to 1_000_000.
+            prefetch (int, optional): [the number of chunks read ahead of the one being processed]. Defaults to 2.
+
+        Yields:
+            [np.ndarray]: [point cloud structured arrays]
+
+        Raises:
+            RuntimeError: if the pipeline fails, including partway through the stream
+        """
+        self.output_epsg = epsg
+        pipeline = self.get_pipeline(region, polygon)
+
+        try:
+            for arr in pipeline.iterator(chunk_size=chunk_size, prefetch=prefetch):
+                yield arr
+            self.logger.info('Pipeline executed successfully.')
+        except RuntimeError:
+            self.logger.exception('Pipeline execution failed')
+            raise
+
     def make_geo_df(self, arr: dict):
         """
         This method creates a geopandas dataframe from a dictionary.
@@ -112,15 +231,26 @@ class LidarProcessor:
         Returns:
             [Geopandas.GeoDataFrame]: [a geopandas dataframe]
         """
-        geometry_points = [Point(x, y) for x, y in zip(arr["X"], arr["Y"])]
-        elevetions = arr["Z"]
-        df = gpd.GeoDataFrame(columns=["elevation", "geometry"])
-        df['elevation'] = elevetions
-        df['geometry'] = geometry_points
-        df = df.set_geometry("geometry")
-        df.set_crs(self.output_epsg, inplace=True)
+        geometry_points = shapely.points(arr["X"], arr["Y"])
+        elevetions = arr["Z"].astype(np.float32, copy=False)
+        df = gpd.GeoDataFrame({"elevation": elevetions}, geometry=geometry_points, crs=self.output_epsg)
         return df
 
+    def crop_to_polygon(self, arr: np.ndarray, polygon: Polygon) -> np.ndarray:
+        """
+        This method keeps only the points of a point cloud array that lie strictly inside a polygon.
+        Points exactly on the polygon's boundary are dropped.
+
+        Args:
+            arr (np.ndarray): [a point cloud structured array with X and Y fields in the polygon's CRS]
+            polygon (Polygon): [a polygon object]
+
+        Returns:
+            [np.ndarray]: [the points of the array inside the polygon]
+        """
+        mask = shapely.contains_xy(polygon, arr["X"], arr["Y"])
+        return arr[mask]
+
     def get_regions(self, polygon: Polygon, epsg: int) -> list:
         """
         This method fetches all the region filenames that contain the polygon.
@@ -133,21 +263,35 @@ class LidarProcessor:
             [list]: [list of all the region filenames that contain the polygon]
         """
         self.output_epsg = epsg
-        polygon_df = gpd.GeoDataFrame([polygon], columns=['geometry'])
+        minx, miny, maxx, maxy = self.get_input_bounds(polygon)
 
-        polygon_df.set_crs(epsg=self.output_epsg, inplace=True)
-        polygon_df['geometry'] = polygon_df['geometry'].to_crs(epsg=self.input_epsg)
-        minx, miny, maxx, maxy = polygon_df['geometry'][0].bounds
+        return list(self._get_regions_in_bounds(minx, miny, maxx, maxy))
+
+    def _get_regions_in_bounds(self, minx: float, miny: float, maxx: float, maxy: float) -> tuple:
+        """
+        This method returns the year-sorted region filenames whose extent contains a bounding box in the input CRS.
+        Results are memoized per bounding box since the metadata does not change, the oldest entry is evicted once
+        the cache holds _regions_cache_size bounding boxes.
+
+        Args:
+            minx (float): [the minimum x coordinate of the bounding box in the input CRS]
+            miny (float): [the minimum y coordinate of the bounding box in the input CRS]
+            maxx (float): [the maximum x coordinate of the bounding box in the input CRS]
+            maxy (float): [the maximum y coordinate of the bounding box in the input CRS]
 
-        cond_xmin = self.metadata.xmin <= minx
-        cond_xmax = self.metadata.xmax >= maxx
-        cond_ymin = self.metadata.ymin <= miny
-        cond_ymax = self.metadata.ymax >= maxy
+        Returns:
+            [tuple]: [the region filenames that contain the bounding box, sorted by year]
+        """
+        key = (minx, miny, maxx, maxy)
+        if key not in self._regions_cache:
+            if len(self._regions_cache) >= LidarProcessor._regions_cache_size:
+                del self._regions_cache[next(iter(self._regions_cache))]
+            mask = (self._meta_xmin <= minx) & (self._meta_xmax >= maxx) & (self._meta_ymin <= miny) & (self._meta_ymax >= maxy)
 
-        df = self.metadata[cond_xmin & cond_xmax & cond_ymin & cond_ymax]
-        sort_df = df.sort_values(by=['year'])
-        regions = sort_df['filename'].to_list()
-        return regions
+            idx = np.where(mask)[0]
+            order = np.argsort(self._meta_year[idx], kind='stable')
+            self._regions_cache[key] = tuple(self._meta_filename[idx[order]].tolist())
+        return self._regions_cache[key]
 
     def get_region_data(self, polygon: Polygon, epsg: int, region: str):
         """
@@ -160,10 +304,14 @@ class LidarProcessor:
 
         Returns:
             [Geopandas.GeoDataFrame]: [a geopandas dataframe]
+
+        Raises:
+            RuntimeError: if fetching the region fails, no partial data is returned
         """
-        pipeline = self.run_pipeline(polygon, epsg, region)
-        arr = pipeline.arrays[0]
-        return self.make_geo_df(arr)
+        chunks = [self.make_geo_df(self.crop_to_polygon(arr, polygon)) for arr in self.stream_pipeline(polygon, epsg, region)]
+        if not chunks:
+            return gpd.GeoDataFrame({"elevation": []}, geometry=[], crs=epsg)
+        return pd.concat(chunks, ignore_index=True)
 
     def get_data(self, polygon: Polygon, epsg: int) -> dict:
         """
@@ -180,26 +328,50 @@ class LidarProcessor:
 
         regions = self.get_regions(polygon, epsg)
         region_dict = {}
-        for region in regions:
-            year = int(self.metadata[self.metadata.filename == region].year.values[0])
+        if not regions:
+            return region_dict
+
+        with ThreadPoolExecutor(max_workers=min(8, len(regions))) as executor:
+            futures = {region: executor.submit(self.get_region_data, polygon, epsg, region) for region in regions}
+
+        # results are collected in the year-sorted order of the regions, not in completion order
+        for region, future in futures.items():
+            year = self._filename_to_year.get(region, 0)
             if year == 0:
                 year = 'unknown'
-            region_df = self.get_region_data(polygon, epsg, region)
+            region_df = future.result()
             empty = region_df.empty
             if not empty:
                 region_dict[year] = region_df
 
         return region_dict
 
-    def plot_terrain_3d(self, gdf: gpd.GeoDataFrame, fig_size: tuple=(12, 10), size: float=0.01):
+    def plot_terrain_3d(self, gdf: gpd.GeoDataFrame, fig_size: tuple=(12, 10), size: float=0.01, max_points: int = 50_000):
         """
         This method displays points in a geodataframe as a 3d scatter plot.
+        Point clouds larger than max_points are rendered with pyvista when it is installed,
+        otherwise every n-th point is kept so that at most max_points are plotted with matplotlib.
 
         Args:
             gdf (gpd.GeoDataFrame): [a geopandas dataframe containing points in the geometry column and height in the elevation column.]
             fig_size (tuple, optional): [filesze of the figure to be displayed]. Defaults to (12, 10).
-            size (float, optional): [size of the points to be plotted]. Defaults to 0.01.
+            size (float, optional): [size of the points to be plotted with matplotlib, pyvista always draws 1 pixel points]. Defaults to 0.01.
+            max_points (int, optional): [the largest number of points plotted with matplotlib]. Defaults to 50_000.
         """
+        if len(gdf) > max_points:
+            try:
+                import pyvista as pv
+            except ImportError:
+                step = ceil(len(gdf) / max_points)
+                self.logger.info(f'pyvista is not installed, plotting every {step}th of {len(gdf)} points.')
+                gdf = gdf.iloc[::step]
+            else:
+                points = np.column_stack((shapely.get_coordinates(gdf.geometry.values), gdf.elevation.to_numpy()))
+                pv.PolyData(points).plot(scalars=points[:, 2], point_size=1, window_size=[100 * s for s in fig_size])
+                return
+
+        import matplotlib.pyplot as plt
+
         fig, ax = plt.subplots(1, 1, figsize=fig_size)
         ax = plt.axes(projection='3d')
         ax.scatter(gdf.geometry.x, gdf.geometry.y, gdf.elevation, s=size)
@@ -217,29 +389,30 @@ class LidarProcessor:
             [Geopandas.GeoDataFrame]: [a geopandas dataframe]
         """
 
-        points = np.vstack((gdf.geometry.x, gdf.geometry.y, gdf.elevation)).transpose()
-
-        voxel_size=res
+        xy = shapely.get_coordinates(gdf.geometry.values)
+        points = np.column_stack((xy, gdf.elevation.to_numpy()))
+        del xy
 
-        non_empty_voxel_keys, inverse, nb_pts_per_voxel = np.unique(((points - np.min(points, axis=0)) // voxel_size).astype(int), axis=0, return_inverse=True, return_counts=True)
-        idx_pts_vox_sorted=np.argsort(inverse)
+        origin = np.min(points, axis=0)
+        points = points - origin
 
-        voxel_grid={}
-        grid_barycenter=[]
-        last_seen=0
+        voxel_size=res
 
-        for idx,vox in enumerate(non_empty_voxel_keys):
-            voxel_grid[tuple(vox)]= points[idx_pts_vox_sorted[
-            last_seen:last_seen+nb_pts_per_voxel[idx]]]
-            grid_barycenter.append(np.mean(voxel_grid[tuple(vox)],axis=0))
-            last_seen+=nb_pts_per_voxel[idx]
+        # pack the three voxel indices into one int64 key so np.unique sorts a 1d array instead of rows
+        voxels = (points // voxel_size).astype(np.int64)
+        voxel_keys = np.ravel_multi_index(voxels.T, voxels.max(axis=0) + 1)
 
-        sub_sampled =  np.array(grid_barycenter)
-        df_subsampled = gpd.GeoDataFrame(columns=["elevation", "geometry"])
+        del voxels
 
-        geometry = [Point(x, y) for x, y in zip( sub_sampled[:, 0],  sub_sampled[:, 1])]
+        non_empty_voxel_keys, inverse, nb_pts_per_voxel = np.unique(voxel_keys, return_inverse=True, return_counts=True)
+        del voxel_keys
+        # scatter-add every point into its voxel in one pass instead of sorting the points by voxel
+        inverse = inverse.ravel()
+        nb_voxels = len(non_empty_voxel_keys)
+        sums = np.column_stack([np.bincount(inverse, weights=points[:, j], minlength=nb_voxels) for j in range(points.shape[1])])
 
-        df_subsampled['elevation'] = sub_sampled[:, 2]
-        df_subsampled['geometry'] = geometry
+        sub_sampled = sums / nb_pts_per_voxel[:, None] + origin
+        geometry = shapely.points(sub_sampled[:, 0], sub_sampled[:, 1])
+        df_subsampled = gpd.GeoDataFrame({"elevation": sub_sampled[:, 2], "geometry": geometry})
 
         return df_subsampled
@@ -0,0 +1,154 @@
+import os
+import sys
+import unittest
+import numpy as np
+import geopandas as gpd
+import shapely
+from shapely.geometry import box
+
+sys.path.append(os.path.abspath(os.path.join('../scripts')))
+from lidar_processor import LidarProcessor
+
+
+def reference_subsample(points, voxel_size):
+    # the original per-voxel loop, kept as the expected behaviour of subsample
+    non_empty_voxel_keys, inverse, nb_pts_per_voxel = np.unique(((points - np.min(points, axis=0)) // voxel_size).astype(int), axis=0, return_inverse=True, return_counts=True)
+    idx_pts_vox_sorted = np.argsort(inverse.ravel())
+
+    grid_barycenter = []
+    last_seen = 0
+    for idx in range(len(non_empty_voxel_keys)):
+        grid_barycenter.append(np.mean(points[idx_pts_vox_sorted[last_seen:last_seen + nb_pts_per_voxel[idx]]], axis=0))
+        last_seen += nb_pts_per_voxel[idx]
+
+    return np.array(grid_barycenter)
+
+
+def reference_regions(metadata, minx, miny, maxx, maxy):
+    # the original pandas filter, with a stable sort so regions of the same year keep the csv order
+    df = metadata[(metadata.xmin <= minx) & (metadata.xmax >= maxx) & (metadata.ymin <= miny) & (metadata.ymax >= maxy)]
+    return df.sort_values(by=['year'], kind='stable')['filename'].to_list()
+
+
+def make_gdf(points):
+    return gpd.GeoDataFrame({"elevation": points[:, 2]}, geometry=shapely.points(points[:, 0], points[:, 1]))
+
+
+def subsampled_points(gdf):
+    return np.column_stack((shapely.get_coordinates(gdf.geometry.values), gdf.elevation.to_numpy()))
+
+
+class TestLidarProcessor(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = LidarProcessor()
+
+    def test_subsample_matches_reference(self):
+        # EPSG:3857-scale negative coordinates on a 0.25 m grid
+        rng = np.random.default_rng(0)
+        points = np.column_stack((
+            -10_000_000 + rng.integers(0, 400, 2000) * 0.25,
+            5_000_000 + rng.integers(0, 400, 2000) * 0.25,
+            200 + rng.integers(0, 120, 2000) * 0.25,
+        ))
+        result = subsampled_points(self.processor.subsample(make_gdf(points), 3))
+        expected = reference_subsample(points, 3)
+        self.assertEqual(result.shape, expected.shape)
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-3)
+
+    def test_subsample_matches_reference_off_grid(self):
+        # random EPSG:3857-scale coordinates that do not sit on any grid
+        rng = np.random.default_rng(1)
+        points = np.column_stack((
+            rng.uniform(-10_000_100, -10_000_000, 5000),
+            rng.uniform(5_000_000, 5_000_100, 5000),
+            rng.uniform(200, 230, 5000),
+        ))
+        result = subsampled_points(self.processor.subsample(make_gdf(points), 1))
+        expected = reference_subsample(points, 1)
+        self.assertEqual(result.shape, expected.shape)
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-6)
+
+    def test_subsample_just_below_voxel_edge(self):
+        # points a micrometre below a voxel edge stay in the lower voxel
+        origin = np.array([-10_000_000.0, 5_000_000.0, 10.0])
+        offsets = np.array([
+            [0.0, 0.0, 0.0],
+            [300.0 - 1e-6, 0.0, 0.0],
+            [300.0, 0.0, 0.0],
+            [0.0, 600.0 - 1e-6, 0.0],
+            [0.0, 600.0, 0.0],
+        ])
+        points = origin + offsets
+        result = subsampled_points(self.processor.subsample(make_gdf(points), 3))
+        expected = reference_subsample(points, 3)
+        self.assertEqual(len(result), 5)
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-6)
+
+    def test_subsample_voxel_boundary(self):
+        # a point exactly on a voxel boundary belongs to the upper voxel
+        points = np.array([
+            [-10_000_000.0, 5_000_000.0, 10.0],
+            [-9_999_997.5, 5_000_000.0, 10.0],
+            [-9_999_997.0, 5_000_000.0, 10.0],
+            [-9_999_994.0, 5_000_000.0, 10.0],
+        ])
+        result = subsampled_points(self.processor.subsample(make_gdf(points), 3))
+        expected = reference_subsample(points, 3)
+        self.assertEqual(len(result), 3)
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-3)
+
+    def test_subsample_output_order(self):
+        # voxels (1, 0, 0), (0, 5, 0) and (0, 0, 0) come out in lexicographic voxel order
+        points = np.array([
+            [3.0, 0.0, 0.0],
+            [0.0, 15.0, 0.0],
+            [0.0, 0.0, 0.0],
+        ])
+        result = subsampled_points(self.processor.subsample(make_gdf(points), 3))
+        expected = reference_subsample(points, 3)
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-3)
+        np.testing.assert_allclose(result[1], [0.0, 15.0, 0.0], rtol=0, atol=1e-3)
+
+    def test_crop_to_polygon(self):
+        arr = np.array(
+            [(0.5, 0.5, 1.0), (2.0, 2.0, 2.0), (0.25, 0.75, 3.0), (1.0, 0.5, 4.0), (-0.5, 0.5, 5.0)],
+            dtype=[('X', np.float64), ('Y', np.float64), ('Z', np.float64)],
+        )
+        cropped = self.processor.crop_to_polygon(arr, box(0, 0, 1, 1))
+        # interior points are kept, exterior points and the point on the boundary are dropped
+        np.testing.assert_array_equal(cropped['Z'], [1.0, 3.0])
+
+    def test_get_regions_matches_reference(self):
+        # EPSG:3857 polygons, so the bounds are not changed by reprojection
+        for polygon in [
+            box(-10396204, 5155073, -10396004, 5155273),
+            box(-11677618, 4830530, -11677418, 4830730),
+            box(-100, -100, 100, 100),
+        ]:
+            regions = self.processor.get_regions(polygon, 3857)
+            expected = reference_regions(self.processor.metadata, *polygon.bounds)
+            self.assertEqual(regions, expected)
+
+    def test_get_regions_returns_copies(self):
+        polygon = box(-10396204, 5155073, -10396004, 5155273)
+        regions = self.processor.get_regions(polygon, 3857)
+        self.assertTrue(regions)
+        regions.append('not_a_region')
+        repeated = self.processor.get_regions(polygon, 3857)
+        self.assertIsNot(regions, repeated)
+        self.assertEqual(repeated, regions[:-1])
+
+    def test_regions_cache_is_bounded(self):
+        size = LidarProcessor._regions_cache_size
+        first = (-10396204.0, 5155073.0, -10396004.0, 5155273.0)
+        self.processor._get_regions_in_bounds(*first)
+        for i in range(size + 44):
+            self.processor._get_regions_in_bounds(float(i), 0.0, float(i) + 1, 1.0)
+            self.assertLessEqual(len(self.processor._regions_cache), size)
+        self.assertEqual(len(self.processor._regions_cache), size)
+        # the oldest bounding box is evicted first
+        self.assertNotIn(first, self.processor._regions_cache)
+
+if __name__ == '__main__':
+    unittest.main()